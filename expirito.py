@@ -1,83 +1,265 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import errno
 import logging
+import logging.handlers
+import os
 import shutil
+import stat
 import sys
 import time
 from pathlib import Path
-from typing import Any, Dict, Optional, cast
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
 import yaml
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s: %(message)s")
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore[assignment]
+
+# Log records are buffered and written out in chunks instead of with a write
+# per moved or deleted entry. Warnings and errors flush the buffer, and so does
+# leaving __main__.
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s: %(message)s"))
+_log_handler = logging.handlers.MemoryHandler(
+    capacity=1024, flushLevel=logging.WARNING, target=_log_stream_handler
+)
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
+
+# Upper bound on the number of configured directories cleaned concurrently.
+MAX_WORKERS = 8
+
+# The entries of every directory in a tree, keyed by the directory's path
+# relative to the root of the tree.
+TreeContents = Dict[str, List[os.DirEntry]]
+
+# Upper bound on the entries of a tree kept from its age check to remove it
+# without walking it again. Larger trees are removed with shutil.rmtree.
+MAX_COLLECTED_ENTRIES = 10_000
+
+# Flags for opening a subdirectory to list, stat and unlink entries relative to
+# it. Subdirectories are never followed through symlinks.
+DIRECTORY_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+
+# Errors from following a symlink that mean its target does not exist.
+DANGLING_SYMLINK_ERRORS = {errno.ENOENT, errno.ENOTDIR, errno.ELOOP}
+
+# Errors with which os.copy_file_range reports that it cannot copy between the
+# given files, in which case copy2_nofollow falls back to shutil.copy2.
+COPY_FILE_RANGE_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+}
+
+
+def copy2_nofollow(src: str, dst: str) -> str:
+    """Modified version of copy2 to pass to shutil.move
+
+    Regular files are copied in kernel space with os.copy_file_range where the
+    platform supports it, which lets copy-on-write filesystems share extents.
+    """
+    if not hasattr(os, "copy_file_range") or not stat.S_ISREG(os.lstat(src).st_mode):
+        return shutil.copy2(src, dst, follow_symlinks=False)
 
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+    except OSError as e:
+        if e.errno not in COPY_FILE_RANGE_UNSUPPORTED:
+            raise
+        return shutil.copy2(src, dst, follow_symlinks=False)
 
-def copy2_nofollow(*args):
-    """Modified version of copy2 to pass to shutil.move"""
-    return shutil.copy2(*args, follow_symlinks=False)
+    shutil.copystat(src, dst, follow_symlinks=False)
+    return dst
 
 
-def move_to_holding(file_path: Path, holding_directory: Path, dry_run: bool) -> Path:
+def move_to_holding(
+    file_path: str,
+    holding_directory: str,
+    dry_run: bool,
+    created_dirs: Optional[Set[str]] = None,
+) -> str:
     """Move the file to the holding directory, replicating the entire path.
 
+    Paths are handled as plain strings, since this runs once per moved entry.
+
     Args:
         file_path: The file path to be moved.
         holding_directory: The holding directory path.
         dry_run: If True, print the action without actually moving the file.
+        created_dirs: Destination directories already created, shared across
+                      calls so each one is only created once.
 
     Returns:
         The destination path in the holding directory.
     """
+    if created_dirs is None:
+        created_dirs = set()
+
     # Create a relative path for the file by removing the root
-    relative_path = file_path.relative_to(file_path.anchor)
+    relative_path = file_path.lstrip(os.sep)
 
     # Create the destination path in the holding directory
-    destination_path = holding_directory / relative_path
+    destination_path = os.path.join(holding_directory, relative_path)
 
-    # Create the destination directory if it doesn't exist
-    destination_directory = destination_path.parent
-    if not destination_directory.exists():
-        if not dry_run:
-            destination_directory.mkdir(parents=True)
+    # Create the destination directory if it hasn't been already. Other
+    # workers may be creating the same parents concurrently.
+    destination_directory = os.path.dirname(destination_path)
+    if not dry_run and destination_directory not in created_dirs:
+        os.makedirs(destination_directory, exist_ok=True)
+        created_dirs.add(destination_directory)
 
     if not dry_run:
-        shutil.move(str(file_path), str(destination_path), copy_function=copy2_nofollow)
+        try:
+            os.rename(file_path, destination_path)
+        except OSError:
+            # Crossing filesystems, or a destination that needs shutil's handling.
+            shutil.move(file_path, destination_path, copy_function=copy2_nofollow)
 
     return destination_path
 
 
-def is_old_enough(path: Path, age_limit: int, current_time: float) -> bool:
-    """Check if a file or directory is older than the specified age limit.
+def _scandir_recursive(name: str, dir_fd: int) -> Iterator[Tuple[str, os.DirEntry]]:
+    """Yield every entry beneath a directory, without following symlinks.
+
+    Every directory is opened relative to its parent's descriptor, and its
+    entries are stat'ed relative to its own, so no path is resolved from the
+    root. A directory stays open while its subdirectories are walked, which
+    keeps one descriptor and one listing open per level of the tree.
 
     Args:
-        path: The path to the file or directory.
-        age_limit: The age limit in days.
-        current_time: The current time in seconds since the epoch.
+        name: The name of the directory to walk.
+        dir_fd: A descriptor for the directory containing it.
+
+    Yields:
+        A tuple of the containing directory's path relative to the walked
+        directory ("" for its own entries) and the DirEntry, for each file,
+        directory and symlink under it. Directories are yielded before their
+        contents.
+    """
+    fd = os.open(name, DIRECTORY_FLAGS, dir_fd=dir_fd)
+    try:
+        stack = [("", fd, os.scandir(fd))]
+    except BaseException:
+        os.close(fd)
+        raise
+
+    try:
+        while stack:
+            rel, fd, it = stack[-1]
+            entry = next(it, None)
+            if entry is None:
+                stack.pop()
+                it.close()
+                os.close(fd)
+                continue
+            yield rel, entry
+            if entry.is_dir(follow_symlinks=False):
+                child_fd = os.open(entry.name, DIRECTORY_FLAGS, dir_fd=fd)
+                try:
+                    child_it = os.scandir(child_fd)
+                except BaseException:
+                    os.close(child_fd)
+                    raise
+                stack.append((os.path.join(rel, entry.name), child_fd, child_it))
+    finally:
+        for _, fd, it in stack:
+            it.close()
+            os.close(fd)
+
+
+def is_tree_old_enough(
+    entry: os.DirEntry, dir_fd: int, cutoff: float, max_collected: int = 0
+) -> Optional[TreeContents]:
+    """Check if all files and subdirectories under a given directory are older
+    than the specified cutoff.
+
+    The directory's own mtime is checked first: creating, removing or renaming
+    a child updates it, so a recently changed directory is rejected without
+    reading it at all. Otherwise the walk stops at the first entry that is
+    too recent, and an empty directory costs a single read.
+
+    Args:
+        entry: The directory entry for the directory.
+        dir_fd: A descriptor for the directory containing it.
+        cutoff: Entries modified before this time, in seconds since the epoch,
+                are old enough.
+        max_collected: The most entries to collect for removing the tree.
+                       Larger trees are still checked, but their entries are
+                       not kept.
 
     Returns:
-        True if the entry is older than the age limit, False otherwise.
+        None if some entry in the tree is too recent. Otherwise the entries of
+        every directory in the tree, keyed by its path relative to the
+        directory, or an empty dict if there are more than max_collected.
     """
-    age_in_seconds = current_time - path.stat().st_mtime
-    age_in_days = age_in_seconds / (60 * 60 * 24)
-    return age_in_days > age_limit
-
+    if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+        return None
+
+    contents: TreeContents = {}
+    collected = 0
+    for rel, e in _scandir_recursive(entry.name, dir_fd):
+        if e.stat(follow_symlinks=False).st_mtime >= cutoff:
+            return None
+        collected += 1
+        if collected <= max_collected:
+            contents.setdefault(rel, []).append(e)
+        elif contents:
+            contents.clear()
+    return contents
+
+
+def _remove_tree(
+    entry: os.DirEntry,
+    dir_fd: int,
+    contents: TreeContents,
+    path: str,
+    rel: str = "",
+) -> None:
+    """Remove a directory tree using the entries collected while checking it.
 
-def is_tree_old_enough(path: Path, age_limit: int, current_time: float) -> bool:
-    """Check if all files and subdirectories under a given path are older than
-    the specified age limit.
+    The age check and the removal share a single walk of the tree: the
+    entries are not listed or stat'ed again here. As with shutil.rmtree, every
+    directory is opened relative to its parent and checked to be the one that
+    was walked, so a symlink swapped in meanwhile can't redirect the removal.
+    The tree may have changed since it was walked, so entries that can't be
+    removed are logged and left in place.
 
     Args:
-        path: The path to the directory.
-        age_limit: The age limit in days.
-        current_time: The current time in seconds since the epoch.
-
-    Returns:
-        True if all entries in the tree are older than the age limit, False otherwise.
+        entry: The directory entry for the root of the tree.
+        dir_fd: A descriptor for the directory containing the root.
+        contents: The entries of every directory in the tree, as returned by
+                  is_tree_old_enough.
+        path: The path to the root of the tree, for logging.
+        rel: The root's path relative to the top of the tree.
+
+    Raises:
+        OSError: If the root itself can't be opened or removed, for instance
+                 because entries were added to the tree or left in it.
     """
-    return is_old_enough(path, age_limit, current_time) and all(
-        is_old_enough(p, age_limit, current_time) for p in path.glob("**/*")
-    )
+    fd = os.open(entry.name, DIRECTORY_FLAGS, dir_fd=dir_fd)
+    try:
+        if not os.path.samestat(entry.stat(follow_symlinks=False), os.fstat(fd)):
+            raise OSError(f"{path} was replaced after it was walked")
+        for e in contents.get(rel, []):
+            e_path = os.path.join(path, e.name)
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    _remove_tree(e, fd, contents, e_path, os.path.join(rel, e.name))
+                else:
+                    os.unlink(e.name, dir_fd=fd)
+            except OSError as err:
+                logging.warning(f"Could not remove {e_path}: {err}")
+    finally:
+        os.close(fd)
+    os.rmdir(entry.name, dir_fd=dir_fd)
 
 
 def clean_folder(
@@ -96,47 +278,90 @@ def clean_folder(
                            empty directories are moved here instead of being deleted.
         dry_run: If True, print the actions without actually making changes.
     """
-    current_time = time.time()
-    for entry_path in folder_path.iterdir():
-        action = None
-        if entry_path.is_symlink():
-            target = entry_path.resolve(strict=False)
-            if not target.exists():
-                if holding_directory:
-                    action = "move"
-                else:
-                    action = "delete"
-        else:
-            if (
-                entry_path.is_file()
-                and is_old_enough(entry_path, days_old, current_time)
-            ) or (
-                entry_path.is_dir()
-                and is_tree_old_enough(entry_path, days_old, current_time)
-            ):
-                if holding_directory:
-                    action = "move"
+    cutoff = time.time() - days_old * 60 * 60 * 24
+    folder = os.fspath(folder_path)
+    holding = os.fspath(holding_directory) if holding_directory else ""
+    created_dirs: Set[str] = set()
+
+    # Entries are stat'ed and deleted relative to the folder's descriptor. The
+    # folder itself may be a symlink, so it is opened following links.
+    dir_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with os.scandir(dir_fd) as it:
+            for entry in it:
+                action = None
+                kind = None
+                tree_entries: Optional[TreeContents] = None
+                # The type checks are answered from the d_type readdir returns,
+                # without a syscall on filesystems that fill it in, so an entry
+                # is only stat'ed once its kind is known.
+                if entry.is_symlink():
+                    kind = "symlink"
+                    try:
+                        entry.stat()
+                    except OSError as e:
+                        # Only act when the symlink target does not exist. Other
+                        # errors, such as EACCES, say nothing about the target.
+                        if e.errno in DANGLING_SYMLINK_ERRORS:
+                            action = "move" if holding_directory else "delete"
+                        else:
+                            logging.warning(
+                                f"Skipping {os.path.join(folder, entry.name)}: {e}"
+                            )
+                elif entry.is_dir(follow_symlinks=False):
+                    kind = "dir"
+                    # Moved trees are renamed whole, so only deletions need the
+                    # entries of the tree, and only up to a bound on the memory
+                    # they take. A tree that can't be fully read, or
+                    # that changes while it is walked, is left alone without
+                    # stopping the rest of the cleanup.
+                    try:
+                        tree_entries = is_tree_old_enough(
+                            entry,
+                            dir_fd,
+                            cutoff,
+                            0 if holding_directory else MAX_COLLECTED_ENTRIES,
+                        )
+                    except OSError as e:
+                        logging.warning(
+                            f"Skipping {os.path.join(folder, entry.name)}: {e}"
+                        )
+                        tree_entries = None
+                    if tree_entries is not None:
+                        action = "move" if holding_directory else "delete"
+                elif entry.is_file(follow_symlinks=False):
+                    kind = "file"
+                    if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        action = "move" if holding_directory else "delete"
+
+                if action is None:
+                    continue
+
+                entry_path = os.path.join(folder, entry.name)
+                if action == "move":
+                    destination_path = move_to_holding(
+                        entry_path, holding, dry_run, created_dirs
+                    )
+                    logging.info(f"Moved {entry_path} to {destination_path}")
+                elif action == "delete":
+                    if not dry_run:
+                        # A tree may have changed since it was walked.
+                        try:
+                            if kind == "dir" and tree_entries:
+                                _remove_tree(entry, dir_fd, tree_entries, entry_path)
+                            elif kind == "dir":
+                                # Empty, or too large for its entries to be kept.
+                                shutil.rmtree(entry.name, dir_fd=dir_fd)
+                            else:
+                                os.unlink(entry.name, dir_fd=dir_fd)
+                        except OSError as e:
+                            logging.warning(f"Could not remove {entry_path}: {e}")
+                            continue
+                    logging.info(f"Deleted {entry_path}")
                 else:
-                    action = "delete"
-
-        if action is None:
-            continue
-        elif action == "move":
-            destination_path = move_to_holding(
-                entry_path, cast(Path, holding_directory), dry_run
-            )
-            action_log = f"Moved {entry_path} to {destination_path}"
-        elif action == "delete":
-            if not dry_run:
-                if entry_path.is_file() or entry_path.is_symlink():
-                    entry_path.unlink()
-                else:
-                    shutil.rmtree(entry_path)
-            action_log = f"Deleted {entry_path}"
-        else:
-            raise NotImplementedError(f"Unexpected action state [{action}].")
-
-        logging.info(action_log)
+                    raise NotImplementedError(f"Unexpected action state [{action}].")
+    finally:
+        os.close(dir_fd)
 
 
 def read_config(config_path: Path) -> Dict[str, Any]:
@@ -148,28 +373,66 @@ def read_config(config_path: Path) -> Dict[str, Any]:
     Returns:
         The configuration as a dictionary.
     """
-    with open(config_path, "rt") as f:
-        config = yaml.safe_load(f)
+    config = yaml.load(config_path.read_bytes(), Loader=SafeLoader)
+
+    # Light validation of config file. Every problem is collected first, so
+    # they can all be reported at once.
+    errors = []
 
-    # Light validation of config file.
-    #
     # Holding directory needs to be present.
-    if not Path(config["holding_directory"]).exists():
-        logging.error(f"Configuration path [{config_path}] does not exist.")
-        sys.exit(1)
+    holding_directory = config["holding_directory"]
+    if not os.path.exists(holding_directory):
+        errors.append(f"Holding directory [{holding_directory}] does not exist.")
 
     # Check monitored directories.
     for cd in config["directories"]:
-        if not Path(cd["path"]).exists():
-            logging.warn(f"Configuration path [{config_path}] does not exist.")
+        if not os.path.exists(cd["path"]):
+            logging.warning(f"Configuration path [{cd['path']}] does not exist.")
         age_limit = cd["age_limit"]
         if not (isinstance(age_limit, int) and (age_limit > 0)):
-            logging.error(f"Invalid age_limit [{age_limit}] provided.")
-            sys.exit(1)
+            errors.append(
+                f"Invalid age_limit [{age_limit}] provided for [{cd['path']}]."
+            )
+
+    if errors:
+        for error in errors:
+            logging.error(error)
+        sys.exit(1)
 
     return config
 
 
+def clean_directory(
+    folder_path: Path,
+    days_old: int,
+    holding_directory: Path,
+    holding_age_limit: int,
+    dry_run: bool,
+) -> None:
+    """Expire a monitored directory's counterpart in the holding directory, then
+    move old entries of the monitored directory to holding.
+
+    Args:
+        folder_path: The monitored folder path.
+        days_old: The age limit in days for entries of the monitored folder.
+        holding_directory: The holding directory path.
+        holding_age_limit: The age limit in days for entries in holding.
+        dry_run: If True, print the actions without actually making changes.
+    """
+    # Delete from holding pass. It runs first so it does not walk the entries
+    # this run is about to move in. The holding counterpart only exists once
+    # something has been moved there, so try it rather than stat'ing first.
+    deletion_path = holding_directory / folder_path.relative_to(folder_path.anchor)
+    try:
+        clean_folder(deletion_path, holding_age_limit, None, dry_run)
+    except FileNotFoundError as e:
+        if e.filename != str(deletion_path):
+            raise
+
+    # Move to holding pass.
+    clean_folder(folder_path, days_old, holding_directory, dry_run)
+
+
 def parse_arguments() -> argparse.Namespace:
     """Parse command-line arguments.
 
@@ -203,17 +466,30 @@ def main(config_path: Path, dry_run: bool) -> None:
     holding_directory = Path(config["holding_directory"])
     holding_age_limit = config["holding_age_limit"]
 
-    for directory in config["directories"]:
-        folder_path = Path(directory["path"])
-        days_old = directory["age_limit"]
-
-        # Move to holding pass.
-        clean_folder(folder_path, days_old, holding_directory, dry_run)
-
-        # Delete from holding pass.
-        deletion_path = holding_directory / str(folder_path).lstrip("/")
-        if deletion_path.exists():
-            clean_folder(deletion_path, holding_age_limit, None, dry_run)
+    directories = config["directories"]
+    max_workers = max(1, min(MAX_WORKERS, len(directories)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                clean_directory,
+                Path(directory["path"]),
+                directory["age_limit"],
+                holding_directory,
+                holding_age_limit,
+                dry_run,
+            ): directory["path"]
+            for directory in directories
+        }
+        failed = False
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logging.exception(f"Cleaning [{futures[future]}] failed.")
+                failed = True
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -225,4 +501,7 @@ if __name__ == "__main__":
         logging.error(f"Configuration file not found at {config_path}")
         sys.exit(1)
 
-    main(config_path, args.dry_run)
+    try:
+        main(config_path, args.dry_run)
+    finally:
+        _log_handler.flush()
@@ -2,6 +2,8 @@ import os
 from datetime import datetime, timedelta
 from pathlib import Path
 
+import pytest
+
 import expirito
 
 
@@ -19,10 +21,10 @@ def test_move_to_holding(tmp_path):
 
     old_file = test_dir / "old.txt"
     create_test_file(old_file, 10)
-    expirito.move_to_holding(test_dir, holding, 5)
+    expirito.move_to_holding(str(test_dir), str(holding), False)
 
     assert not old_file.exists()
-    assert (holding / str(test_dir) / "old.txt").exists()
+    assert (holding / test_dir.relative_to("/") / "old.txt").exists()
 
 
 def test_clean_folder(tmp_path):
@@ -45,3 +47,303 @@ def test_clean_folder(tmp_path):
 
     assert not old_file.exists()
     assert (holding / str(test_dir) / "old.txt").exists()
+
+
+def test_clean_folder_moves_only_old_trees(tmp_path):
+    holding = tmp_path / "holding"
+    holding.mkdir()
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    old_tree = test_dir / "old_tree"
+    old_tree.mkdir()
+    create_test_file(old_tree / "old.txt", 10)
+    create_test_file(old_tree, 10)
+
+    mixed_tree = test_dir / "mixed_tree"
+    mixed_tree.mkdir()
+    create_test_file(mixed_tree / "old.txt", 10)
+    create_test_file(mixed_tree / "new.txt", 1)
+    create_test_file(mixed_tree, 10)
+
+    expirito.clean_folder(test_dir, 5, holding, False)
+
+    assert not old_tree.exists()
+    assert (holding / old_tree.relative_to("/") / "old.txt").exists()
+    assert (mixed_tree / "old.txt").exists()
+    assert (mixed_tree / "new.txt").exists()
+
+
+def test_clean_folder_deletes_only_old_trees(tmp_path):
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    old_tree = test_dir / "old_tree"
+    (old_tree / "sub").mkdir(parents=True)
+    create_test_file(old_tree / "sub" / "old.txt", 10)
+    create_test_file(old_tree / "old.txt", 10)
+    create_test_file(old_tree / "sub", 10)
+    create_test_file(old_tree, 10)
+
+    mixed_tree = test_dir / "mixed_tree"
+    mixed_tree.mkdir()
+    create_test_file(mixed_tree / "old.txt", 10)
+    create_test_file(mixed_tree / "new.txt", 1)
+    create_test_file(mixed_tree, 10)
+
+    expirito.clean_folder(test_dir, 5, None, False)
+
+    assert not old_tree.exists()
+    assert (mixed_tree / "old.txt").exists()
+    assert (mixed_tree / "new.txt").exists()
+
+
+def test_clean_directory_expires_holding(tmp_path):
+    holding = tmp_path / "holding"
+    holding.mkdir()
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    # Nothing has been moved to holding from this directory yet.
+    expirito.clean_directory(test_dir, 5, holding, 90, False)
+
+    held_dir = holding / test_dir.relative_to("/")
+    held_dir.mkdir(parents=True)
+    expired_file = held_dir / "expired.txt"
+    create_test_file(expired_file, 100)
+    held_file = held_dir / "held.txt"
+    create_test_file(held_file, 10)
+    moved_file = test_dir / "moved.txt"
+    create_test_file(moved_file, 100)
+
+    expirito.clean_directory(test_dir, 5, holding, 90, False)
+
+    assert not expired_file.exists()
+    assert held_file.exists()
+    # Entries moved in by this run are not swept until the next one.
+    assert not moved_file.exists()
+    assert (held_dir / "moved.txt").exists()
+
+
+def test_copy2_nofollow(tmp_path):
+    src = tmp_path / "src.txt"
+    src.write_text("expirito")
+    create_test_file(src, 10)
+    dst = tmp_path / "dst.txt"
+
+    expirito.copy2_nofollow(str(src), str(dst))
+
+    assert dst.read_text() == "expirito"
+    assert dst.stat().st_mtime == src.stat().st_mtime
+
+
+def test_clean_folder_empty_directories(tmp_path):
+    holding = tmp_path / "holding"
+    holding.mkdir()
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    old_dir = test_dir / "old_dir"
+    old_dir.mkdir()
+    create_test_file(old_dir, 10)
+    new_dir = test_dir / "new_dir"
+    new_dir.mkdir()
+
+    expirito.clean_folder(test_dir, 5, holding, False)
+
+    assert not old_dir.exists()
+    assert (holding / old_dir.relative_to("/")).is_dir()
+    assert new_dir.exists()
+
+
+def test_read_config_reports_all_errors(tmp_path, caplog):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(
+        f"holding_directory: {tmp_path / 'missing'}\n"
+        "holding_age_limit: 90\n"
+        "directories:\n"
+        f"  - path: {tmp_path}\n"
+        "    age_limit: 0\n"
+        f"  - path: {tmp_path}\n"
+        "    age_limit: 5\n"
+    )
+
+    with pytest.raises(SystemExit):
+        expirito.read_config(config_path)
+
+    errors = [r.message for r in caplog.records if r.levelname == "ERROR"]
+    assert len(errors) == 2
+    assert "missing" in errors[0]
+    assert "age_limit [0]" in errors[1]
+
+
+def test_clean_folder_moves_only_dangling_symlinks(tmp_path):
+    holding = tmp_path / "holding"
+    holding.mkdir()
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    dangling = test_dir / "dangling"
+    dangling.symlink_to(tmp_path / "missing")
+    loop = test_dir / "loop"
+    loop.symlink_to(loop)
+    live = test_dir / "live"
+    live.symlink_to(holding)
+
+    expirito.clean_folder(test_dir, 5, holding, False)
+
+    assert not dangling.is_symlink()
+    assert not loop.is_symlink()
+    assert live.is_symlink()
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason="root bypasses permission checks")
+def test_clean_folder_keeps_symlinks_to_unreadable_targets(tmp_path):
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    private = tmp_path / "private"
+    private.mkdir()
+    (private / "target.txt").touch()
+    link = test_dir / "link"
+    link.symlink_to(private / "target.txt")
+    private.chmod(0)
+
+    try:
+        expirito.clean_folder(test_dir, 5, None, False)
+    finally:
+        private.chmod(0o700)
+
+    assert link.is_symlink()
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason="root bypasses permission checks")
+def test_clean_folder_skips_unreadable_trees(tmp_path):
+    holding = tmp_path / "holding"
+    holding.mkdir()
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    tree = test_dir / "tree"
+    private = tree / "private"
+    private.mkdir(parents=True)
+    create_test_file(private, 10)
+    create_test_file(tree, 10)
+    old_file = test_dir / "old.txt"
+    create_test_file(old_file, 10)
+    private.chmod(0)
+
+    try:
+        expirito.clean_folder(test_dir, 5, holding, False)
+    finally:
+        private.chmod(0o700)
+
+    assert private.exists()
+    assert not old_file.exists()
+    assert (holding / old_file.relative_to("/")).exists()
+
+
+def test_remove_tree_tolerates_changes_since_the_walk(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "sub").mkdir(parents=True)
+    create_test_file(tree / "sub" / "old.txt", 10)
+    create_test_file(tree / "gone.txt", 10)
+    create_test_file(tree / "sub", 10)
+    create_test_file(tree, 10)
+
+    cutoff = (datetime.now() - timedelta(days=5)).timestamp()
+    dir_fd = os.open(tmp_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with os.scandir(dir_fd) as it:
+            (entry,) = it
+        contents = expirito.is_tree_old_enough(entry, dir_fd, cutoff, 100)
+        assert contents is not None
+
+        # The tree changes between the age check and the removal.
+        (tree / "gone.txt").unlink()
+        (tree / "sub" / "new.txt").touch()
+
+        with pytest.raises(OSError):
+            expirito._remove_tree(entry, dir_fd, contents, str(tree))
+    finally:
+        os.close(dir_fd)
+
+    assert not (tree / "sub" / "old.txt").exists()
+    assert (tree / "sub" / "new.txt").exists()
+
+
+def test_remove_tree_does_not_follow_swapped_symlinks(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "sub").mkdir(parents=True)
+    create_test_file(tree / "sub" / "old.txt", 10)
+    create_test_file(tree / "sub", 10)
+    create_test_file(tree, 10)
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "old.txt").touch()
+
+    cutoff = (datetime.now() - timedelta(days=5)).timestamp()
+    dir_fd = os.open(tmp_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with os.scandir(dir_fd) as it:
+            (entry,) = [e for e in it if e.name == "tree"]
+        contents = expirito.is_tree_old_enough(entry, dir_fd, cutoff, 100)
+        assert contents is not None
+
+        # A walked subdirectory is swapped for a symlink before the removal.
+        (tree / "sub" / "old.txt").unlink()
+        (tree / "sub").rmdir()
+        (tree / "sub").symlink_to(outside)
+
+        with pytest.raises(OSError):
+            expirito._remove_tree(entry, dir_fd, contents, str(tree))
+    finally:
+        os.close(dir_fd)
+
+    assert (outside / "old.txt").exists()
+
+
+def test_clean_folder_deletes_trees_too_large_to_collect(tmp_path, monkeypatch):
+    monkeypatch.setattr(expirito, "MAX_COLLECTED_ENTRIES", 2)
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+
+    large_tree = test_dir / "large_tree"
+    (large_tree / "sub").mkdir(parents=True)
+    for i in range(3):
+        create_test_file(large_tree / "sub" / f"old{i}.txt", 10)
+    create_test_file(large_tree / "sub", 10)
+    create_test_file(large_tree, 10)
+
+    expirito.clean_folder(test_dir, 5, None, False)
+
+    assert not large_tree.exists()
+
+
+def test_main_reports_every_failed_directory(tmp_path, caplog):
+    holding = tmp_path / "holding"
+    holding.mkdir()
+    test_dir = tmp_path / "test"
+    test_dir.mkdir()
+    old_file = test_dir / "old.txt"
+    create_test_file(old_file, 10)
+
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(
+        f"holding_directory: {holding}\n"
+        "holding_age_limit: 90\n"
+        "directories:\n"
+        f"  - path: {tmp_path / 'missing1'}\n"
+        "    age_limit: 5\n"
+        f"  - path: {test_dir}\n"
+        "    age_limit: 5\n"
+        f"  - path: {tmp_path / 'missing2'}\n"
+        "    age_limit: 5\n"
+    )
+
+    with pytest.raises(SystemExit):
+        expirito.main(config_path, False)
+
+    errors = [r.message for r in caplog.records if r.levelname == "ERROR"]
+    assert len(errors) == 2
+    assert not old_file.exists()